@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+
+def precache_dataset(dataset, out_dir, num_workers=4):
+    """ Decode every image of a dataset once and store them in out_dir, to be read by CachedTensorDataset
+
+    The images are written one after the other into a single uint8 file (images.bin),
+    with their offset and shape in index.npy and their labels in labels.npy.
+
+    Args:
+        dataset (Dataset) : dataset returning (uint8 tensor of shape (C, H, W), label) pairs
+        out_dir (str) : directory to store the cache in
+        num_workers (int) : number of subprocesses used to decode the images
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # batch_size=None returns the samples one by one, the images can have different sizes
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+    index, labels = [], []
+    offset = 0
+    with open(os.path.join(out_dir, 'images.bin'), 'wb') as f:
+        for image, label in tqdm(loader, desc=f'Caching decoded images to {out_dir}'):
+            image = image.numpy().astype(np.uint8)
+            f.write(image.tobytes())
+            index.append((offset, *image.shape))
+            labels.append(label)
+            offset += image.size
+    np.save(os.path.join(out_dir, 'labels.npy'), np.array(labels))
+    # the index is written last, so that its presence marks a complete cache
+    np.save(os.path.join(out_dir, 'index.npy'), np.array(index, dtype=np.int64))
+
+
+class CachedTensorDataset(Dataset):
+    """ Dataset of images decoded ahead of time by precache_dataset, read through a memory map
+
+    Args:
+        cache_dir (str) : directory written by precache_dataset
+        transform (callable) : transform applied to the uint8 image tensors
+    """
+    def __init__(self, cache_dir, transform=None):
+        self.images_path = os.path.join(cache_dir, 'images.bin')
+        self.index = np.load(os.path.join(cache_dir, 'index.npy'))
+        self.labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+        self.transform = transform
+        # opened lazily, so that every data loader worker maps the file itself
+        self.images = None
+
+    def __getstate__(self):
+        # never pickle the memory map itself (it would be copied into the new process)
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = np.memmap(self.images_path, dtype=np.uint8, mode='r')
+        offset, channels, height, width = self.index[idx]
+        image = np.array(self.images[offset:offset + channels * height * width])
+        image = torch.from_numpy(image).view(channels, height, width)
+        label = self.labels[idx]
+        if self.transform:
+            image = self.transform(image)
+        return image, label
@@ -2,6 +2,7 @@
 
 import numpy as np
 import torch
+from torchvision.transforms import functional as TF
 
 class HistogramNormalize(object):
     """
@@ -31,5 +32,61 @@ class HistogramNormalize(object):
         return image
 
 
+class ShrinkToSize(object):
+    """
+    Resize an image so that its shorter side is at most size, smaller images are left untouched.
+    Args:
+        size: Maximum size of the shorter side of the image.
+        interpolation: Interpolation used when shrinking the image.
+    """
+
+    def __init__(self, size, interpolation=TF.InterpolationMode.BICUBIC):
+        self.size = size
+        self.interpolation = interpolation
+
+    def __call__(self, image):
+        if min(TF.get_image_size(image)) <= self.size:
+            return image
+        return TF.resize(image, self.size, interpolation=self.interpolation)
+
+
+class BatchHistogramNormalize(object):
+    """
+    Apply histogram normalization to a batch of images (N, C, H, W), e.g. on the GPU.
+    Gives the same result as applying HistogramNormalize to each image in the batch.
+    Args:
+        number_bins: Number of bins to use in histogram.
+    """
+
+    def __init__(self, number_bins=256):
+        self.number_bins = number_bins
+
+    def __call__(self, images):
+        batch_size = images.size(0)
+        flat = images.reshape(batch_size, -1).float()
+
+        # get image histograms, with the bins spanning the range of each image
+        low = flat.min(dim=1, keepdim=True).values
+        high = flat.max(dim=1, keepdim=True).values
+        # as in numpy, a constant image gets a range of width 1 around its value
+        constant = high == low
+        low = torch.where(constant, low - 0.5, low)
+        high = torch.where(constant, high + 0.5, high)
+        position = (flat - low) / (high - low) * self.number_bins
+        bin_index = position.long().clamp(0, self.number_bins - 1)
+        image_histogram = torch.zeros(batch_size, self.number_bins, device=images.device)
+        image_histogram.scatter_add_(1, bin_index, torch.ones_like(flat))
+        cdf = image_histogram.cumsum(dim=1)  # cumulative distribution function
+        cdf = 255 * cdf / cdf[:, -1:]  # normalize
+
+        # use linear interpolation of cdf (between the left bin edges) to find new pixel values
+        left = position.floor().clamp(0, self.number_bins - 2)
+        weight = (position - left).clamp(0, 1)
+        left = left.long()
+        image_equalized = torch.lerp(cdf.gather(1, left), cdf.gather(1, left + 1), weight)
+
+        return image_equalized.reshape(images.shape)
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -5,6 +5,9 @@
 
 import os
 import argparse
+import contextlib
+import datetime
+import inspect
 from pprint import pprint
 import logging
 
@@ -12,20 +15,25 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader, ConcatDataset
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, ConcatDataset, Subset
 from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import datasets, transforms, models
 
 import PIL
 import numpy as np
 from tqdm import tqdm
 
-from sklearn.metrics import confusion_matrix, roc_auc_score
+from sklearn.metrics import roc_auc_score
 
 from datasets.custom_chexpert_dataset import CustomChexpertDataset
 from datasets.custom_diabetic_retinopathy_dataset import CustomDiabeticRetinopathyDataset
 from datasets.custom_stoic_dataset import CustomStoicDataset
-from datasets.transforms import HistogramNormalize
+from datasets.cached_tensor_dataset import CachedTensorDataset, precache_dataset
+from datasets.transforms import BatchHistogramNormalize, ShrinkToSize
 from models.backbones import ResNetBackbone, ResNet18Backbone, DenseNetBackbone
 
 
@@ -53,34 +61,178 @@ class AverageMeter(object):
         return fmtstr.format(**self.__dict__)
 
 
+class CUDAPrefetcher(object):
+    """Iterates endlessly over a data loader, copying the next batch to the device
+    on a side CUDA stream while the current batch is being processed."""
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.epoch = 0
+        self.loader_iter = None
+
+    def __iter__(self):
+        self._new_epoch()
+        self._preload()
+        return self
+
+    def _new_epoch(self):
+        # reshuffle the shards of the distributed sampler every epoch
+        if isinstance(self.loader.sampler, DistributedSampler):
+            self.loader.sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        self.loader_iter = iter(self.loader)
+
+    def _preload(self):
+        try:
+            data, targets = next(self.loader_iter)
+        except StopIteration:
+            self._new_epoch()
+            data, targets = next(self.loader_iter)
+
+        if self.stream is None:
+            self.next_data = data.to(self.device)
+            self.next_targets = targets.to(self.device).long()
+            return
+        with torch.cuda.stream(self.stream):
+            # copy from pinned memory asynchronously, the labels are cast on the device
+            self.next_data = data.to(self.device, non_blocking=True)
+            self.next_targets = targets.to(self.device, non_blocking=True).long()
+
+    def __next__(self):
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the batch was allocated on the side stream, keep its memory alive for the compute stream
+            self.next_data.record_stream(current_stream)
+            self.next_targets.record_stream(current_stream)
+        data, targets = self.next_data, self.next_targets
+        self._preload()
+        return data, targets
+
+
+# name: autocast dtype
+AMP_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
 def count_acc(pred, label, metric):
+    # the score is returned as a device tensor, the caller decides when to sync
     if metric == 'accuracy':
-        return pred.eq(label.view_as(pred)).to(torch.float32).mean().item()
+        return pred.eq(label.view_as(pred)).to(torch.float32).mean()
     elif metric == 'mean per-class accuracy':
-        # get the confusion matrix
-        cm = confusion_matrix(label.cpu(), pred.detach().cpu())
-        cm = cm.diagonal() / cm.sum(axis=1)
+        # get the confusion matrix, computed on the device with a single bincount
+        pred, label = pred.detach().view(-1).long(), label.view(-1).long()
+        num_classes = int(torch.max(pred.max(), label.max()).item()) + 1
+        cm = torch.bincount(label * num_classes + pred, minlength=num_classes ** 2).view(num_classes, num_classes)
+        # classes that never occur in the labels are left out of the mean
+        support = cm.sum(dim=1)
+        cm = cm.diagonal()[support > 0] / support[support > 0]
         return cm.mean()
 
 
+# gloo group used to wait for long running work of the main process (e.g. building the dataset cache),
+# which would exceed the timeout of the default nccl group
+_wait_group = None
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def init_distributed(local_rank):
+    global _wait_group
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl')
+    _wait_group = dist.new_group(backend='gloo', timeout=datetime.timedelta(hours=24))
+
+
+def wait_for_main_process():
+    if is_distributed():
+        dist.barrier(group=_wait_group)
+
+
+def broadcast_from_main(value):
+    # nccl can only communicate cuda tensors
+    value = torch.tensor(value, dtype=torch.float64, device=torch.cuda.current_device())
+    dist.broadcast(value, src=0)
+    return value.item()
+
+
+def setup_for_distributed(is_master):
+    """Disable printing when not in the master process."""
+    import builtins as __builtin__
+    builtin_print = __builtin__.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    __builtin__.print = print
+
+
+def compile_module(module):
+    # CUDA graphs remove the per-kernel launch overhead. Compilation is lazy and happens on the
+    # first forward pass, so any compilation error is raised from there.
+    return torch.compile(module, mode='reduce-overhead', fullgraph=False)
+
 
 # Testing classes and functions
 
 class FinetuneModel(nn.Module):
-    def __init__(self, model, num_classes, steps, metric, device, feature_dim):
+    def __init__(self, model, num_classes, steps, metric, device, feature_dim, amp='off', transform=None,
+                 accum_steps=1):
         super().__init__()
         self.num_classes = num_classes
         self.steps = steps
+        self.accum_steps = accum_steps
         self.metric = metric
         self.device = device
+        self.transform = transform
         self.model = nn.Sequential(model, nn.Linear(feature_dim, num_classes))
         self.model = self.model.to(self.device)
+        self.ddp_model = None
+        if is_distributed():
+            self.model = DDP(self.model, device_ids=[torch.cuda.current_device()], bucket_cap_mb=25)
+            # kept to skip the gradient all-reduce when accumulating, also after the model is compiled
+            self.ddp_model = self.model
         self.model.train()
         self.criterion = nn.CrossEntropyLoss()
-
-    def tune(self, train_loader, test_loader, lr, wd, early_stopping=False, val_loader=None, patience=3):
-        # set up optimizer
-        optimizer = optim.SGD(self.model.parameters(), lr=lr, momentum=0.9, nesterov=True, weight_decay=wd)
+        # mixed precision is only used on the GPU, CPU runs stay in full precision
+        self.use_amp = amp != 'off' and str(self.device).startswith('cuda')
+        if amp == 'auto':
+            # prefer bf16 (Ampere and newer), which needs no loss scaling, and fall back to fp16.
+            # The compute capability is checked, as is_bf16_supported() is also true where bf16 is only emulated
+            amp = 'bf16' if self.use_amp and torch.cuda.get_device_capability(self.device)[0] >= 8 else 'fp16'
+        self.amp_dtype = AMP_DTYPES.get(amp, torch.float16)
+        # bf16 has the same exponent range as fp32, so only fp16 needs loss scaling
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
+
+    def tune(self, train_loader, test_loader, lr, wd, early_stopping=False, val_loader=None, patience=3,
+             log_interval=50):
+        # scale the learning rate with the effective batch size when training data-parallel
+        lr = lr * get_world_size()
+        # set up optimizer, on the GPU the update of all parameters is batched into a few kernels
+        # (the fused implementation of SGD only exists in recent PyTorch versions)
+        sgd_kwargs = {}
+        if str(self.device).startswith('cuda'):
+            if 'fused' in inspect.signature(optim.SGD).parameters:
+                sgd_kwargs['fused'] = True
+            else:
+                sgd_kwargs['foreach'] = True
+        optimizer = optim.SGD(self.model.parameters(), lr=lr, momentum=0.9, nesterov=True, weight_decay=wd,
+                              **sgd_kwargs)
         scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=self.steps)
         print(optimizer)
         logging.info(optimizer)
@@ -93,59 +245,78 @@ class FinetuneModel(nn.Module):
             early_stop_counter = 0
             early_stop = False
         step = 0
-        pbar = tqdm(range(self.steps), desc='Training')
-        running = True
-        while running:
-            for data, targets in train_loader:
-                if step >= self.steps:
-                    running = False
-                    break
-
-                targets = targets.type(torch.LongTensor)
-                data, targets = data.to(self.device), targets.to(self.device)
-                optimizer.zero_grad()
-                output = self.model(data)
-                loss = self.criterion(output, targets)
-                output = output.argmax(dim=1)
-                # during training we can always track traditional accuracy, it'll be easier
-                acc = 100. * count_acc(output, targets, "accuracy")
-                loss.backward()
-
-                optimizer.step()
-
-                train_loss.update(loss.item(), data.size(0))
-                train_acc.update(acc, data.size(0))
-                pbar.update(1)
+        microstep = 0
+        loss_buf, acc_buf = [], []
+        pbar = tqdm(range(self.steps), desc='Training', disable=not is_main_process())
+        # the prefetcher restarts the loader by itself, so no outer loop over epochs is needed
+        for data, targets in CUDAPrefetcher(train_loader, self.device):
+            if step >= self.steps:
+                break
+
+            if self.transform is not None:
+                data = self.transform(data)
+            data = data.contiguous(memory_format=torch.channels_last)
+            # accumulate the gradients of accum_steps mini-batches for every optimizer step,
+            # they are only all-reduced between processes on the last of them
+            update = (microstep + 1) % self.accum_steps == 0
+            if self.ddp_model is not None and not update:
+                sync_context = self.ddp_model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+                    output = self.model(data)
+                    loss = self.criterion(output, targets)
+                self.scaler.scale(loss / self.accum_steps).backward()
+            output = output.argmax(dim=1)
+            # during training we can always track traditional accuracy, it'll be easier
+            acc_buf.append(count_acc(output, targets, "accuracy"))
+            loss_buf.append(loss.detach())
+            microstep += 1
+            if not update:
+                continue
+
+            self.scaler.step(optimizer)
+            self.scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+            pbar.update(1)
+            # only sync the losses and accuracies and refresh the progress bar every log_interval steps
+            if (step + 1) % log_interval == 0 or step + 1 == self.steps:
+                train_loss.update(torch.stack(loss_buf).mean().item(), data.size(0) * len(loss_buf))
+                train_acc.update(100. * torch.stack(acc_buf).mean().item(), data.size(0) * len(acc_buf))
+                loss_buf, acc_buf = [], []
                 pbar.set_postfix(loss=train_loss, acc=train_acc, lr=f"{scheduler.optimizer.param_groups[0]['lr']:.6f}")
-                scheduler.step()
-
-                step += 1
-
-                # early stopping
-                if early_stopping:
-                    # check every 200 steps
-                    if step % 200 == 0:
-                        val_loss, val_acc = self.test_classifier(val_loader)
-                        if best_acc is None:
-                            best_acc = val_acc
-                            best_state_dict = self.model.state_dict()
-                        elif val_acc < best_acc:
-                            early_stop_counter += 1
-                            if early_stop_counter >= patience:
-                                early_stop = True
-                        else:
-                            best_acc = val_acc
-                            early_stop_counter = 0
-                            best_state_dict = self.model.state_dict()
-
-                    if early_stop:
-                        print(f'Early stopping at step # {step} / 5000, best acc on val set {best_acc:.2f}%')
-                        logging.info(f'Early stopping at step # {step} / 5000, best acc on val set {best_acc:.2f}%')
-                        running = False
-                        self.model.load_state_dict(best_state_dict)
-                        break
-
-
+            scheduler.step()
+
+            step += 1
+
+            # early stopping
+            if early_stopping:
+                # check every 200 steps
+                if step % 200 == 0:
+                    val_loss, val_acc = self.test_classifier(val_loader)
+                    if is_distributed():
+                        # BN statistics differ slightly between processes, so every process
+                        # follows the early stopping decision of the main process
+                        val_acc = broadcast_from_main(val_acc)
+                    if best_acc is None:
+                        best_acc = val_acc
+                        best_state_dict = self.model.state_dict()
+                    elif val_acc < best_acc:
+                        early_stop_counter += 1
+                        if early_stop_counter >= patience:
+                            early_stop = True
+                    else:
+                        best_acc = val_acc
+                        early_stop_counter = 0
+                        best_state_dict = self.model.state_dict()
+
+                if early_stop:
+                    print(f'Early stopping at step # {step} / 5000, best acc on val set {best_acc:.2f}%')
+                    logging.info(f'Early stopping at step # {step} / 5000, best acc on val set {best_acc:.2f}%')
+                    self.model.load_state_dict(best_state_dict)
+                    break
 
         pbar.close()
 
@@ -156,14 +327,22 @@ class FinetuneModel(nn.Module):
         self.model.eval()
         test_loss, test_acc = 0, 0
         num_data_points = 0
-        preds, labels = [], []
+        if self.metric == 'mean per-class accuracy':
+            # predictions and labels are written into preallocated buffers on the device
+            preds = torch.empty(len(data_loader.sampler), dtype=torch.long, device=self.device)
+            labels = torch.empty_like(preds)
         with torch.no_grad():
-            for i, (data, targets) in enumerate(tqdm(data_loader, desc=' Testing')):
+            for i, (data, targets) in enumerate(tqdm(data_loader, desc=' Testing', disable=not is_main_process())):
+                offset = num_data_points
                 num_data_points += data.size(0)
-                targets = targets.type(torch.LongTensor)
-                data, targets = data.to(self.device), targets.to(self.device)
-                output = self.model(data)
-                tl = self.criterion(output, targets).item()
+                data = data.to(self.device, non_blocking=True)
+                targets = targets.to(self.device, non_blocking=True).long()
+                if self.transform is not None:
+                    data = self.transform(data)
+                data = data.contiguous(memory_format=torch.channels_last)
+                with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+                    output = self.model(data)
+                    tl = self.criterion(output, targets)
                 tl *= data.size(0)
                 test_loss += tl
 
@@ -172,19 +351,17 @@ class FinetuneModel(nn.Module):
                     ta *= data.size(0)
                     test_acc += ta
                 elif self.metric == 'mean per-class accuracy':
-                    pred = output.argmax(dim=1).detach()
-                    preds.append(pred)
-                    labels.append(targets)
+                    preds[offset:num_data_points] = output.argmax(dim=1).detach()
+                    labels[offset:num_data_points] = targets
 
 
+        # a single device sync for the whole test set
         if self.metric == 'accuracy':
-            test_acc /= num_data_points
+            test_acc = test_acc.item() / num_data_points
         elif self.metric == 'mean per-class accuracy':
-            preds = torch.cat(preds)
-            labels = torch.cat(labels)
-            test_acc = 100. * count_acc(preds, labels, self.metric)
+            test_acc = 100. * count_acc(preds[:num_data_points], labels[:num_data_points], self.metric).item()
 
-        test_loss /= num_data_points
+        test_loss = test_loss.item() / num_data_points
 
         self.model.train()
         return test_loss, test_acc
@@ -193,7 +370,8 @@ class FinetuneModel(nn.Module):
 class FinetuneTester():
     def __init__(self, model_name, train_loader, val_loader, trainval_loader, test_loader,
                  metric, device, num_classes, feature_dim=2048, grid=None, steps=5000,
-                 early_stopping=False, patience=3):
+                 early_stopping=False, patience=3, amp='off', compile_model=False, device_transform=None,
+                 accum_steps=1, freeze_for_validate=False, train_noaug_loader=None):
         self.model_name = model_name
         self.train_loader = train_loader
         self.val_loader = val_loader
@@ -207,47 +385,149 @@ class FinetuneTester():
         self.steps = steps
         self.early_stopping = early_stopping
         self.patience = patience
+        self.amp = amp
+        self.compile_model = compile_model
+        self.device_transform = device_transform
+        self.accum_steps = accum_steps
+        self.freeze_for_validate = freeze_for_validate
+        self.train_noaug_loader = train_noaug_loader
         self.best_params = {}
+        # CPU copy of the pretrained backbone weights, shared by all runs of the grid
+        self._init_state = None
+
+    def validate(self, nprocs=1):
+        if self.freeze_for_validate:
+            results = self._validate_frozen()
+        elif nprocs > 1:
+            # the grid cells are independent, so spread them over one process per GPU
+            print(f'Running the hyperparameter search over {nprocs} processes')
+            logging.info(f'Running the hyperparameter search over {nprocs} processes')
+            queue = mp.get_context('spawn').SimpleQueue()
+            mp.spawn(_grid_search_worker, args=(nprocs, self, queue), nprocs=nprocs)
+            results = sorted(queue.get() for _ in self.grid)
+            for i, val_acc in results:
+                logging.info(f'Run {i}: lr={self.grid[i][0]}, wd={self.grid[i][1]}, val accuracy {val_acc:.2f}%')
+        else:
+            results = [(i, self._run_cell(i, lr, wd, self.device)) for i, (lr, wd) in enumerate(self.grid)]
 
-    def validate(self):
         best_score = 0
+        for i, val_acc in results:
+            lr, wd = self.grid[i]
+            if val_acc > best_score:
+                best_score = val_acc
+                self.best_params['lr'] = lr
+                self.best_params['wd'] = wd
+                print(f"New best {self.best_params}")
+                logging.info(f"New best {self.best_params}")
+
+        if is_distributed():
+            # the val scores can differ slightly between processes, use the parameters found by the main process
+            best_params = [self.best_params]
+            dist.broadcast_object_list(best_params, src=0)
+            self.best_params = best_params[0]
+
+    def _validate_frozen(self):
+        """Fast hyperparameter search: the backbone is kept frozen, so its features are only
+        computed once and each run of the grid only trains a linear head on them."""
+        self._load_backbone(self.device)
+        # the features are computed once, from the whole (unsharded) training set without augmentations
+        X_train, y_train = self._inference(self.train_noaug_loader, 'train')
+        X_val, y_val = self._inference(self.val_loader, 'val')
+
+        results = []
         for i, (lr, wd) in enumerate(self.grid):
             print(f'Run {i}')
             logging.info(f'Run {i}')
             print(f'lr={lr}, wd={wd}')
             logging.info(f'lr={lr}, wd={wd}')
+            val_acc = self._fit_linear_head(X_train, y_train, X_val, y_val, lr, wd)
+            print(f'Linear head val accuracy {val_acc:.2f}%')
+            logging.info(f'Linear head val accuracy {val_acc:.2f}%')
+            results.append((i, val_acc))
+        return results
 
+    def _inference(self, loader, split):
+        self.model.eval()
+        features, labels = [], []
+        with torch.no_grad():
+            for data, targets in tqdm(loader, desc=f'Computing features for {split} set', disable=not is_main_process()):
+                data = data.to(self.device, non_blocking=True)
+                if self.device_transform is not None:
+                    data = self.device_transform(data)
+                data = data.contiguous(memory_format=torch.channels_last)
+                features.append(self.model(data))
+                labels.append(targets.to(self.device, non_blocking=True).long())
+        self.model.train()
+        return torch.cat(features), torch.cat(labels)
 
-            # load pretrained model
-            if 'mimic-chexpert' in self.model_name:
-                self.model = DenseNetBackbone(self.model_name)
-                self.feature_dim = 1024
-            elif 'mimic-cxr' in self.model_name:
-                if 'r18' in self.model_name:
-                    self.model = ResNet18Backbone(self.model_name)
-                    self.feature_dim = 512
-                else:
-                    self.model = DenseNetBackbone(self.model_name)
-                    self.feature_dim = 1024
-            else:
-                self.model = ResNetBackbone(self.model_name)
-                self.feature_dim = 2048
+    def _fit_linear_head(self, X_train, y_train, X_val, y_val, lr, wd):
+        # same optimizer and schedule as for finetuning, on random mini-batches of the cached features
+        head = nn.Linear(self.feature_dim, self.num_classes).to(self.device)
+        optimizer = optim.SGD(head.parameters(), lr=lr, momentum=0.9, nesterov=True, weight_decay=wd)
+        scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=self.steps)
+        criterion = nn.CrossEntropyLoss()
+        batch_size = self.train_loader.batch_size
+        for step in range(self.steps):
+            idx = torch.randint(len(X_train), (batch_size,), device=X_train.device)
+            loss = criterion(head(X_train[idx]), y_train[idx])
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
 
-            self.model = self.model.to(args.device)
+        with torch.no_grad():
+            pred = head(X_val).argmax(dim=1)
+        return 100. * count_acc(pred, y_val, self.metric).item()
 
+    def _run_cell(self, i, lr, wd, device):
+        print(f'Run {i}')
+        logging.info(f'Run {i}')
+        print(f'lr={lr}, wd={wd}')
+        logging.info(f'lr={lr}, wd={wd}')
 
-            self.finetuner = FinetuneModel(self.model, self.num_classes, self.steps,
-                                           self.metric, self.device, self.feature_dim)
-            val_acc = self.finetuner.tune(self.train_loader, self.val_loader, lr, wd)
-            print(f'Finetuned val accuracy {val_acc:.2f}%')
-            logging.info(f'Finetuned val accuracy {val_acc:.2f}%')
+        self._load_backbone(device)
 
-            if val_acc > best_score:
-                best_score = val_acc
-                self.best_params['lr'] = lr
-                self.best_params['wd'] = wd
-                print(f"New best {self.best_params}")
-                logging.info(f"New best {self.best_params}")
+        self.finetuner = FinetuneModel(self.model, self.num_classes, self.steps,
+                                       self.metric, device, self.feature_dim, self.amp,
+                                       self.device_transform, self.accum_steps)
+        if self.compile_model:
+            self.finetuner.model = compile_module(self.finetuner.model)
+        val_acc = self.finetuner.tune(self.train_loader, self.val_loader, lr, wd)
+        print(f'Finetuned val accuracy {val_acc:.2f}%')
+        logging.info(f'Finetuned val accuracy {val_acc:.2f}%')
+        return val_acc
+
+    def _build_backbone(self):
+        # load pretrained model
+        if 'mimic-chexpert' in self.model_name or self.model_name == 'supervised_d121':
+            model = DenseNetBackbone(self.model_name)
+            feature_dim = 1024
+        elif 'mimic-cxr' in self.model_name:
+            if 'r18' in self.model_name:
+                model = ResNet18Backbone(self.model_name)
+                feature_dim = 512
+            else:
+                model = DenseNetBackbone(self.model_name)
+                feature_dim = 1024
+        elif self.model_name == 'supervised_r18':
+            model = ResNet18Backbone(self.model_name)
+            feature_dim = 512
+        else:
+            model = ResNetBackbone(self.model_name)
+            feature_dim = 2048
+        return model, feature_dim
+
+    def _load_backbone(self, device):
+        # load pretrained model from disk for the first run only, later runs reset the weights from memory
+        if self._init_state is None:
+            self.model, self.feature_dim = self._build_backbone()
+            self._init_state = {k: v.detach().cpu().clone() for k, v in self.model.state_dict().items()}
+        else:
+            self.model.load_state_dict(self._init_state)
+
+        self.model = self.model.to(device)
+        # NHWC lets cuDNN pick tensor core conv kernels without extra transposes
+        self.model = self.model.to(memory_format=torch.channels_last)
 
     def evaluate(self, lr=None, wd=None):
         if lr is not None:
@@ -258,29 +538,13 @@ class FinetuneTester():
         print(f"Params {self.best_params}")
         logging.info(f"Params {self.best_params}")
 
-        # load pretrained model
-        if self.model_name in ['mimic-chexpert_lr_0.1', 'mimic-chexpert_lr_0.01', 'mimic-chexpert_lr_1.0', 'supervised_d121']:
-            self.model = DenseNetBackbone(self.model_name)
-            self.feature_dim = 1024
-        elif 'mimic-cxr' in self.model_name:
-            if 'r18' in self.model_name:
-                self.model = ResNet18Backbone(self.model_name)
-                self.feature_dim = 512
-            else:
-                self.model = DenseNetBackbone(self.model_name)
-                self.feature_dim = 1024
-        elif self.model_name == 'supervised_r18':
-            self.model = ResNet18Backbone(self.model_name)
-            self.feature_dim = 512
-        else:
-            self.model = ResNetBackbone(self.model_name)
-            self.feature_dim = 2048
-
-        self.model = self.model.to(args.device)
-
+        self._load_backbone(self.device)
 
         self.finetuner = FinetuneModel(self.model, self.num_classes, self.steps,
-                                       self.metric, self.device, self.feature_dim)
+                                       self.metric, self.device, self.feature_dim, self.amp,
+                                       self.device_transform, self.accum_steps)
+        if self.compile_model:
+            self.finetuner.model = compile_module(self.finetuner.model)
         if self.early_stopping:
             test_score = self.finetuner.tune(self.train_loader, self.test_loader,
                                              self.best_params['lr'], self.best_params['wd'],
@@ -295,16 +559,43 @@ class FinetuneTester():
         return test_score
 
 
+def _grid_search_worker(rank, world_size, tester, queue):
+    # each process finetunes every world_size-th cell of the grid on its own GPU
+    torch.cuda.set_device(rank)
+    for i, (lr, wd) in enumerate(tester.grid):
+        if i % world_size == rank:
+            val_acc = tester._run_cell(i, lr, wd, f'cuda:{rank}')
+            queue.put((i, val_acc))
+
+
 # Data classes and functions
 
-def get_dataset(dset, root, split, transform):
-    return dset(root, train=(split == 'train'), transform=transform, download=True)
+def get_dataset(dset, root, split, transform, cache_dir=None, image_size=224, num_workers=1):
+    if cache_dir is None:
+        # only the main process downloads the dataset, the other processes wait for it to finish
+        if not is_main_process():
+            wait_for_main_process()
+        dataset = dset(root, train=(split == 'train'), transform=transform, download=True)
+        if is_main_process():
+            wait_for_main_process()
+        return dataset
+
+    # decode the images only once, and store them in the cache directory. Images larger than
+    # the image size are shrunk to keep the cache small, smaller images are never upscaled.
+    split_dir = os.path.join(cache_dir, f'{split}_{image_size}')
+    if is_main_process() and not os.path.isfile(os.path.join(split_dir, 'index.npy')):
+        decode = transforms.Compose([
+            ShrinkToSize(image_size),
+            transforms.PILToTensor(),
+        ])
+        precache_dataset(dset(root, train=(split == 'train'), transform=decode, download=True), split_dir, num_workers)
+    # the other processes wait (possibly for hours) until the cache is complete
+    wait_for_main_process()
+    return CachedTensorDataset(split_dir, transform)
 
 
 def get_train_valid_loader(dset,
                            data_dir,
-                           normalise_dict,
-                           hist_norm,
                            batch_size,
                            image_size,
                            random_seed,
@@ -312,16 +603,17 @@ def get_train_valid_loader(dset,
                            shuffle=True,
                            num_workers=1,
                            pin_memory=True,
-                           data_augmentation=True):
+                           data_augmentation=True,
+                           cache_dir=None):
     """
     Utility function for loading and returning train and valid
     multi-process iterators.
+    The images are returned as uint8 tensors, they are converted and normalised on the device.
     If using CUDA, num_workers should be set to 1 and pin_memory to True.
     Params
     ------
     - data_dir: path directory to the dataset.
     - dset: dataset class to load
-    - normalise_dict: dictionary containing the normalisation parameters of the training set
     - batch_size: how many samples per batch to load.
     - image_size: size of images after transforms
     - random_seed: fix seed for reproducibility.
@@ -331,48 +623,35 @@ def get_train_valid_loader(dset,
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - cache_dir: if given, the decoded images are cached in (and read from) this directory.
     Returns
     -------
     - train_loader: training set iterator.
     - valid_loader: validation set iterator.
+    - trainval_loader: training + validation set iterator.
+    - train_noaug_loader: iterator over the whole training set without augmentations, shared by all processes.
     """
     error_msg = "[!] valid_size should be in the range [0, 1]."
     assert ((valid_size >= 0) and (valid_size <= 1)), error_msg
 
-    normalize = transforms.Normalize(**normalise_dict)
+    # CIFAR is held in memory as arrays, there is no decoding to skip by caching it
+    if issubclass(dset, datasets.CIFAR10):
+        cache_dir = None
+    # cached images are already decoded to uint8 tensors
+    to_tensor = [] if cache_dir is not None else [transforms.PILToTensor()]
 
     # define transforms with augmentations
-    if hist_norm:
-        transform_aug = transforms.Compose([
-            transforms.RandomResizedCrop(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            HistogramNormalize(),
-        ])
-    else:
-        transform_aug = transforms.Compose([
-            transforms.RandomResizedCrop(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ])
+    transform_aug = transforms.Compose([
+        transforms.RandomResizedCrop(image_size, interpolation=PIL.Image.BICUBIC),
+        transforms.RandomHorizontalFlip(),
+    ] + to_tensor)
 
 
     # define transform without augmentations
-    if hist_norm:
-        transform_no_aug = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            HistogramNormalize(),
-        ])
-    else:
-        transform_no_aug = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            normalize,
-        ])
+    transform_no_aug = transforms.Compose([
+        transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
+        transforms.CenterCrop(image_size),
+    ] + to_tensor)
 
     if not data_augmentation:
         transform_aug = transform_no_aug
@@ -383,8 +662,8 @@ def get_train_valid_loader(dset,
 
 
     # select a random subset of the train set to form the validation set
-    dataset = get_dataset(dset, data_dir, 'train', transform_aug)
-    valid_dataset = get_dataset(dset, data_dir, 'train', transform_no_aug)
+    dataset = get_dataset(dset, data_dir, 'train', transform_aug, cache_dir, image_size, num_workers)
+    valid_dataset = get_dataset(dset, data_dir, 'train', transform_no_aug, cache_dir, image_size, num_workers)
 
     num_train = len(dataset)
     indices = list(range(num_train))
@@ -395,97 +674,132 @@ def get_train_valid_loader(dset,
         np.random.shuffle(indices)
 
     train_idx, valid_idx = indices[split:], indices[:split]
-    train_sampler = SubsetRandomSampler(train_idx)
     valid_sampler = SubsetRandomSampler(valid_idx)
+    if is_distributed():
+        # shard the training data over the processes, the validation set is evaluated in full by each process
+        train_dataset = Subset(dataset, train_idx)
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=random_seed)
+        trainval_sampler = DistributedSampler(dataset, shuffle=shuffle, seed=random_seed)
+    else:
+        train_dataset = dataset
+        train_sampler = SubsetRandomSampler(train_idx)
+        trainval_sampler = None
 
+    # drop the last incomplete batch when training so that input shapes stay fixed
+    # (a new shape triggers recompilation / CUDA graph re-recording with --compile)
     train_loader = DataLoader(
-        dataset, batch_size=batch_size, sampler=train_sampler,
-        num_workers=num_workers, pin_memory=pin_memory,
+        train_dataset, batch_size=batch_size, sampler=train_sampler,
+        num_workers=num_workers, pin_memory=pin_memory, drop_last=True,
+        persistent_workers=num_workers > 0,
     )
     valid_loader = DataLoader(
         valid_dataset, batch_size=batch_size, sampler=valid_sampler,
         num_workers=num_workers, pin_memory=pin_memory,
+        persistent_workers=num_workers > 0,
     )
     trainval_loader = DataLoader(
-        dataset, batch_size=batch_size, shuffle=shuffle,
+        dataset, batch_size=batch_size, shuffle=(shuffle and trainval_sampler is None), sampler=trainval_sampler,
+        num_workers=num_workers, pin_memory=pin_memory, drop_last=True,
+        persistent_workers=num_workers > 0,
+    )
+
+    # used once to compute the features of the training set (with --freeze-for-validate),
+    # so it is neither augmented nor sharded over the processes
+    train_noaug_loader = DataLoader(
+        Subset(valid_dataset, train_idx), batch_size=batch_size, shuffle=False,
         num_workers=num_workers, pin_memory=pin_memory,
     )
 
-    return train_loader, valid_loader, trainval_loader
+    return train_loader, valid_loader, trainval_loader, train_noaug_loader
 
 
 def get_test_loader(dset,
                     data_dir,
-                    normalise_dict,
-                    hist_norm,
                     batch_size,
                     image_size,
                     shuffle=False,
                     num_workers=1,
-                    pin_memory=True):
+                    pin_memory=True,
+                    cache_dir=None):
     """
     Utility function for loading and returning a multi-process
     test iterator.
+    The images are returned as uint8 tensors, they are converted and normalised on the device.
     If using CUDA, num_workers should be set to 1 and pin_memory to True.
     Params
     ------
     - data_dir: path directory to the dataset.
     - dset: dataset class to load
-    - normalise_dict: dictionary containing the normalisation parameters of the training set
     - batch_size: how many samples per batch to load.
     - image_size: size of images after transforms
     - shuffle: whether to shuffle the dataset after every epoch.
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - cache_dir: if given, the decoded images are cached in (and read from) this directory.
     Returns
     -------
     - data_loader: test set iterator.
     """
 
-    normalize = transforms.Normalize(**normalise_dict)
+    # CIFAR is held in memory as arrays, there is no decoding to skip by caching it
+    if issubclass(dset, datasets.CIFAR10):
+        cache_dir = None
+    # cached images are already decoded to uint8 tensors
+    to_tensor = [] if cache_dir is not None else [transforms.PILToTensor()]
 
     # define transform
-    if hist_norm:
-        transform = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            HistogramNormalize(),
-        ])
-    else:
-        transform = transforms.Compose([
-            transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
-            transforms.CenterCrop(image_size),
-            transforms.ToTensor(),
-            normalize,
-        ])
+    transform = transforms.Compose([
+        transforms.Resize(image_size, interpolation=PIL.Image.BICUBIC),
+        transforms.CenterCrop(image_size),
+    ] + to_tensor)
 
     print("Test transform:", transform)
 
-    dataset = get_dataset(dset, data_dir, 'test', transform)
+    dataset = get_dataset(dset, data_dir, 'test', transform, cache_dir, image_size, num_workers)
 
     data_loader = DataLoader(
         dataset, batch_size=batch_size, shuffle=shuffle,
         num_workers=num_workers, pin_memory=pin_memory,
+        persistent_workers=num_workers > 0,
     )
 
     return data_loader
 
 
-def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_norm, num_workers, data_augmentation):
+def get_device_transform(normalise_dict, hist_norm):
+    """
+    Transform applied to whole batches after they have been copied to the device,
+    converting the uint8 images from the data loaders to normalised float tensors.
+    """
+    if hist_norm:
+        return transforms.Compose([
+            transforms.ConvertImageDtype(torch.float32),
+            BatchHistogramNormalize(),
+        ])
+    return transforms.Compose([
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Normalize(**normalise_dict),
+    ])
+
+
+def prepare_data(dset, data_dir, batch_size, image_size, normalisation, hist_norm, num_workers, data_augmentation,
+                 cache_dir=None):
     print(f'Loading {dset} from {data_dir}, with batch size={batch_size}, image size={image_size}, norm={normalisation}')
     logging.info(f'Loading {dset} from {data_dir}, with batch size={batch_size}, image size={image_size}, norm={normalisation}')
     if normalisation:
         normalise_dict = {'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
     else:
         normalise_dict = {'mean': [0.0, 0.0, 0.0], 'std': [1.0, 1.0, 1.0]}
-    train_loader, val_loader, trainval_loader = get_train_valid_loader(dset, data_dir, normalise_dict, hist_norm,
+    train_loader, val_loader, trainval_loader, train_noaug_loader = get_train_valid_loader(dset, data_dir,
                                                 batch_size, image_size, random_seed=0, num_workers=num_workers,
-                                                pin_memory=False, data_augmentation=data_augmentation)
-    test_loader = get_test_loader(dset, data_dir, normalise_dict, hist_norm, batch_size, image_size, num_workers=num_workers,
-                                                pin_memory=False)
-    return train_loader, val_loader, trainval_loader, test_loader
+                                                pin_memory=True, data_augmentation=data_augmentation,
+                                                cache_dir=cache_dir)
+    test_loader = get_test_loader(dset, data_dir, batch_size, image_size, num_workers=num_workers,
+                                                pin_memory=True, cache_dir=cache_dir)
+    device_transform = get_device_transform(normalise_dict, hist_norm)
+    print("Device transform:", device_transform)
+    return train_loader, val_loader, trainval_loader, train_noaug_loader, test_loader, device_transform
 
 
 # name: {class, root, num_classes, metric}
@@ -506,22 +820,43 @@ if __name__ == "__main__":
     parser.add_argument('-b', '--batch-size', type=int, default=64, help='the size of the mini-batches when inferring features')
     parser.add_argument('-i', '--image-size', type=int, default=224, help='the size of the input images')
     parser.add_argument('-w', '--workers', type=int, default=4, help='the number of workers for loading the data')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='directory to cache the decoded images in, so they are only decoded once')
     parser.add_argument('-s', '--search', action='store_true', default=False, help='whether to perform a hyperparameter search on the lr and wd')
+    parser.add_argument('--freeze-for-validate', action='store_true', default=False,
+                        help='whether to search the hyperparameters with a frozen backbone (training only the linear head)')
+    parser.add_argument('--parallel-search', action='store_true', default=False,
+                        help='whether to spread the hyperparameter search over all available GPUs (one run per GPU)')
     parser.add_argument('-g', '--grid-size', type=int, default=2, help='the number of learning rate values in the search grid')
     parser.add_argument('-e', '--early-stopping', action='store_true', default=False, help='whether to perform early stopping')
     parser.add_argument('-p', '--patience', type=int, default=3, help='patience in units of 200 steps for early stopping')
     parser.add_argument('--lr', type=float, default=1e-2, help='learning rate')
     parser.add_argument('--wd', type=float, default=1e-8, help='weight decay')
     parser.add_argument('--steps', type=int, default=5000, help='the number of finetuning steps')
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='the number of mini-batches to accumulate gradients over for each finetuning step')
     parser.add_argument('--no-da', action='store_true', default=False, help='disables data augmentation during training')
     parser.add_argument('-n', '--no-norm', action='store_true', default=False,
                         help='whether to turn off data normalisation (based on ImageNet values)')
     parser.add_argument('--device', type=str, default='cuda', help='CUDA or CPU training (cuda | cpu)')
+    parser.add_argument('--amp', type=str, default='auto', choices=['auto', 'fp16', 'bf16', 'off'],
+                        help='mixed precision mode used when training on the GPU (auto | fp16 | bf16 | off), '
+                             'auto uses bf16 when the GPU supports it and fp16 otherwise')
+    parser.add_argument('--compile', action='store_true', default=False, help='whether to compile the model with torch.compile')
     args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error('--accum-steps must be at least 1')
     args.norm = not args.no_norm
     args.da = not args.no_da
     del args.no_norm
     del args.no_da
+
+    # distributed data-parallel training, when launched with torchrun
+    if 'LOCAL_RANK' in os.environ:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        init_distributed(local_rank)
+        args.device = f'cuda:{local_rank}'
+        setup_for_distributed(is_main_process())
     pprint(args)
 
 
@@ -531,37 +866,48 @@ if __name__ == "__main__":
         hist_norm = True
 
 
-    # set-up logging
-    log_fname = f'{args.dataset}.log'
-    if not os.path.isdir(f'./logs/finetune/{args.model}'):
-        os.makedirs(f'./logs/finetune/{args.model}')
-    log_path = os.path.join(f'./logs/finetune/{args.model}', log_fname)
-    logging.basicConfig(filename=log_path, filemode='w', level=logging.INFO)
-    logging.info(args)
+    # set-up logging (only the main process writes the log)
+    if is_main_process():
+        log_fname = f'{args.dataset}.log'
+        if not os.path.isdir(f'./logs/finetune/{args.model}'):
+            os.makedirs(f'./logs/finetune/{args.model}')
+        log_path = os.path.join(f'./logs/finetune/{args.model}', log_fname)
+        logging.basicConfig(filename=log_path, filemode='w', level=logging.INFO)
+        logging.info(args)
 
 
     # load dataset
     dset, data_dir, num_classes, metric = FINETUNE_DATASETS[args.dataset]
-    train_loader, val_loader, trainval_loader, test_loader = prepare_data(
+    train_loader, val_loader, trainval_loader, train_noaug_loader, test_loader, device_transform = prepare_data(
         dset, data_dir, args.batch_size, args.image_size, normalisation=args.norm,
-        hist_norm=hist_norm, num_workers=args.workers, data_augmentation=args.da)
+        hist_norm=hist_norm, num_workers=args.workers, data_augmentation=args.da,
+        cache_dir=os.path.join(args.cache_dir, args.dataset) if args.cache_dir else None)
 
-    # set up learning rate and weight decay ranges
-    lr = torch.logspace(-4, -1, args.grid_size).flip(dims=(0,))
-    wd = torch.cat([torch.zeros(1), torch.logspace(-6, -3, args.grid_size)])
-    grid = [(l.item(), (w / l).item()) for l in lr for w in wd]
+    # set up learning rate and weight decay ranges (as plain python floats)
+    lr = np.logspace(-4, -1, args.grid_size)[::-1]
+    wd = np.concatenate([[0.0], np.logspace(-6, -3, args.grid_size)])
+    grid = [(float(l), float(w / l)) for l in lr for w in wd]
 
 
     # evaluate model on dataset by finetuning
     tester = FinetuneTester(args.model, train_loader, val_loader, trainval_loader, test_loader,
                             metric, args.device, num_classes, grid=grid, steps=args.steps,
-                            early_stopping=args.early_stopping, patience=args.patience)
+                            early_stopping=args.early_stopping, patience=args.patience, amp=args.amp,
+                            compile_model=args.compile, device_transform=device_transform,
+                            accum_steps=args.accum_steps, freeze_for_validate=args.freeze_for_validate,
+                            train_noaug_loader=train_noaug_loader)
 
     if args.search:
         print('Performing hyperparameter search for lr and wd')
         # tune hyperparameters
-        tester.validate()
+        if args.parallel_search and not is_distributed():
+            tester.validate(nprocs=torch.cuda.device_count())
+        else:
+            tester.validate()
         # use best hyperparameters to finally evaluate the model
         test_score = tester.evaluate()
     else:
         test_score = tester.evaluate(args.lr, args.wd)
+
+    if is_distributed():
+        dist.destroy_process_group()
@@ -82,6 +82,8 @@ class DenseNetBackbone(nn.Module):
 
     def forward(self, x):
         features = self.model.features(x)
+        # relu -> pool -> flatten is two kernels (flatten is a view), which torch.compile
+        # fuses into one when the whole model is compiled (e.g. finetune.py --compile)
         out = F.relu(features, inplace=True)
         out = F.adaptive_avg_pool2d(out, (1, 1))
         out = torch.flatten(out, 1)